@@ -1,6 +1,13 @@
 from flask import Flask, request, Response, render_template
 import os
 import json
+import threading
+
+import bitstream
+import coordination
+import metrics
+import profiler
+import vivado_env
 
 # Import the two tabs
 from tabs import program_xilinx_fpga
@@ -28,6 +35,24 @@ def get_hw_targets_for_server(server_address):
             return s.get("targets", [])
     return []
 
+def reject_job(errors):
+    """
+    Rejects a job before it is queued, in the same line format the tabs stream.
+    """
+    body = "".join(json.dumps({"type": "log", "line": f"ERROR: {e}\n"}) + "\n" for e in errors)
+    return Response(body, status=400, mimetype='application/json')
+
+
+def start_workers():
+    """
+    Starts the job workers of all tabs. Only the process that serves
+    requests may run them: workers take jobs from the shared queue.
+    """
+    # Evaluate the Vivado settings in the background so the first job doesn't pay for it
+    threading.Thread(target=vivado_env.preload, args=(program_xilinx_fpga.VIVADO_SETTINGS,), daemon=True).start()
+    program_xilinx_fpga.start_worker()
+    program_xilinx_fpga_flash.start_worker()
+    xilinx_tests.start_worker()
 
 
 # ==============================
@@ -58,14 +83,23 @@ def index():
 def upload_bitfile():
     bitfile = request.files['bitfile']
     ltxfile = request.files.get('ltxfile')
+    clearfile = request.files.get('clearfile')
 
     bit_path = os.path.join(program_xilinx_fpga.UPLOAD_FOLDER, bitfile.filename)
     bitfile.save(bit_path)
+    metrics.upload_bytes_total.inc(os.path.getsize(bit_path), kind="bitfile")
 
     ltx_path = None
     if ltxfile and ltxfile.filename != "":
         ltx_path = os.path.join(program_xilinx_fpga.UPLOAD_FOLDER, ltxfile.filename)
         ltxfile.save(ltx_path)
+        metrics.upload_bytes_total.inc(os.path.getsize(ltx_path), kind="ltxfile")
+
+    clear_path = None
+    if clearfile and clearfile.filename != "":
+        clear_path = os.path.join(program_xilinx_fpga.UPLOAD_FOLDER, clearfile.filename)
+        clearfile.save(clear_path)
+        metrics.upload_bytes_total.inc(os.path.getsize(clear_path), kind="clearfile")
 
     selected_server = request.form["hw_server"]
     all_targets = get_hw_targets_for_server(selected_server)
@@ -79,12 +113,62 @@ def upload_bitfile():
             if t["target"] == target_name and t["device"] == device_name:
                 targets.append(t)
 
+    try:
+        bit_meta = bitstream.get_bitstream_metadata(bit_path)
+    except ValueError as e:
+        return reject_job([f"{bitfile.filename}: {e}"])
+    errors = bitstream.check_targets(bit_meta, targets)
+
+    partial = "partial" in request.form
+    static_id = None
+    clear_meta = None
+    if partial:
+        if bit_meta["format"] == "bit" and not bitstream.is_partial(bit_meta):
+            errors.append(f"{bitfile.filename} is not a partial bitstream")
+        try:
+            static_id = int(request.form.get("static_id", ""), 16)
+        except ValueError:
+            pass
+        if static_id is None or not 0 <= static_id <= 0xFFFFFFFF:
+            errors.append("Partial reconfiguration needs the static design USR_ACCESS as a 32-bit hex value")
+
+        if clear_path:
+            try:
+                clear_meta = bitstream.get_bitstream_metadata(clear_path)
+            except ValueError as e:
+                errors.append(f"{clearfile.filename}: {e}")
+        if clear_meta:
+            if clear_meta["format"] == "bit" and not bitstream.is_partial(clear_meta):
+                errors.append(f"{clearfile.filename} is not a partial (clearing) bitstream")
+            clear_part = (clear_meta["part"] or "").lower()
+            bit_part = (bit_meta["part"] or "").lower()
+            if clear_part and bit_part and not (clear_part.startswith(bit_part) or bit_part.startswith(clear_part)):
+                errors.append(f"Clearing bitstream is built for {clear_meta['part']}, "
+                              f"but {bitfile.filename} for {bit_meta['part']}")
+            errors.extend(bitstream.check_targets(clear_meta, targets))
+        elif not clear_path:
+            parts = [bit_meta["part"]] + [t["device"] for t in targets]
+            if any(bitstream.needs_clearing_bitstream(p) for p in parts):
+                errors.append("UltraScale devices need the partition's clearing bitstream "
+                              "(*_partial_clear.bit) before a new partial image")
+    elif clear_path:
+        errors.append("A clearing bitstream is only used with partial reconfiguration")
+    elif bitstream.is_partial(bit_meta):
+        errors.append(f"{bitfile.filename} is a partial bitstream; enable partial reconfiguration")
+    if errors:
+        return reject_job(errors)
 
     job_config = {
         "bit_path": bit_path,
+        "bitstream": bit_meta,
+        "partial": partial,
+        "static_id": static_id,
+        "clear_path": clear_path,
+        "clear_bitstream": clear_meta,
         "ltx_path": ltx_path,
         "hw_server": selected_server,
-        "targets": targets
+        "targets": targets,
+        "profile": "profile" in request.form,
     }
 
     def generate():
@@ -101,6 +185,7 @@ def upload_binfile():
     binfile = request.files['binfile']
     bin_path = os.path.join(program_xilinx_fpga_flash.UPLOAD_FOLDER, binfile.filename)
     binfile.save(bin_path)
+    metrics.upload_bytes_total.inc(os.path.getsize(bin_path), kind="binfile")
 
     selected_server = request.form.get("hw_server")
     all_targets = get_hw_targets_for_server(selected_server)
@@ -114,15 +199,29 @@ def upload_binfile():
             if t["target"] == target_name and t["device"] == device_name:
                 targets.append(t)
 
+    try:
+        bin_meta = bitstream.get_bitstream_metadata(bin_path)
+    except ValueError as e:
+        return reject_job([f"{binfile.filename}: {e}"])
+    errors = bitstream.check_targets(bin_meta, targets)
+
+    verify_mode = request.form.get("verify_mode", "full")
+    if verify_mode not in program_xilinx_fpga_flash.VERIFY_MODES:
+        errors.append(f"Unknown verify mode {verify_mode!r}, expected one of "
+                      + ", ".join(program_xilinx_fpga_flash.VERIFY_MODES))
+    if errors:
+        return reject_job(errors)
 
     job_config = {
         "bin_file": bin_path,
+        "bitstream": bin_meta,
         "hw_server": selected_server,
         "targets": targets,
         "blank_check": "blank_check" in request.form,
         "erase": "erase" in request.form,
         "cfg_program": "cfg_program" in request.form,
-        "verify": "verify" in request.form,
+        "verify_mode": verify_mode,
+        "profile": "profile" in request.form,
     }
 
     def generate():
@@ -139,7 +238,7 @@ def list_hw():
     hw_server = request.form.get("hw_server")
 
     def generate():
-        for item in xilinx_tests.enqueue_hw_list(hw_server):
+        for item in xilinx_tests.enqueue_hw_list(hw_server, get_hw_targets_for_server(hw_server)):
             # item can be string (old behavior) or dict (new tree)
             if isinstance(item, dict):
                 yield json.dumps(item) + "\n"
@@ -148,6 +247,28 @@ def list_hw():
 
     return Response(stream_with_context(generate()), mimetype='application/json')
 
+@app.route('/calibrate_jtag', methods=['POST'])
+def calibrate_jtag():
+    hw_server = request.form.get("hw_server")
+    targets = get_hw_targets_for_server(hw_server)
+
+    def generate():
+        for item in xilinx_tests.enqueue_jtag_calibration(hw_server, targets):
+            yield json.dumps(item) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+@app.route('/jobs/<int:job_id>/output')
+def job_output(job_id):
+    """
+    Streams the output of a job from any server process, e.g. after a reconnect.
+    """
+    def generate():
+        for item in coordination.stream_output(job_id):
+            yield json.dumps(item) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
 @app.route('/get_targets', methods=['POST'])
 def get_targets():
     hw_server = request.form.get("hw_server")
@@ -155,6 +276,25 @@ def get_targets():
     return jsonify({"targets": targets})
 
 
+@app.route('/jobs/<int:job_id>/profile')
+def get_profile(job_id):
+    profile = profiler.load_profile(job_id)
+    if profile is None:
+        return jsonify({"error": f"No profile for job {job_id}"}), 404
+    return jsonify(profile)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=8080)
\ No newline at end of file
+    # The reloader runs this script twice: in a parent that only watches for
+    # changes and restarts, and in the child that serves (WERKZEUG_RUN_MAIN)
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_workers()
+    app.run(debug=True, host='0.0.0.0', port=8080)
+else:
+    # Imported by a WSGI server
+    start_workers()
@@ -0,0 +1,201 @@
+import os
+import re
+import struct
+import hashlib
+import threading
+
+# ==============================
+# Bitstream header parsing
+# ==============================
+# Parses Xilinx .bit headers (design, part, date, length) and the start of
+# the configuration stream (sync word, IDCODE) so that images built for the
+# wrong part are rejected at upload time instead of inside Vivado.
+
+BIT_HEADER_MAGIC = b"\x00\x09\x0f\xf0\x0f\xf0\x0f\xf0\x0f\xf0\x00\x00\x01"
+SYNC_WORD = b"\xaa\x99\x55\x66"
+IDCODE_WRITE = b"\x30\x01\x80\x01"  # Type 1 write, 1 word, IDCODE register
+SCAN_BYTES = 1024 * 1024
+
+# IDCODEs with the revision nibble masked off
+IDCODE_PARTS = {
+    0x03824093: "xcku025",
+    0x03823093: "xcku035",
+    0x03822093: "xcku040",
+    0x03919093: "xcku060",
+    0x0380F093: "xcku085",
+    0x03844093: "xcku095",
+    0x0390D093: "xcku115",
+}
+
+# Parsed metadata, keyed by SHA-256 of the file contents
+metadata_cache = {}
+metadata_lock = threading.Lock()
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def parse_bit_header(data):
+    """
+    Parses the key/value header of a .bit file. Returns the header fields
+    and the offset of the raw configuration data.
+    """
+    if not data.startswith(BIT_HEADER_MAGIC):
+        raise ValueError("Not a Xilinx .bit file (bad header magic)")
+
+    fields = {}
+    pos = len(BIT_HEADER_MAGIC)
+    while pos < len(data):
+        key = chr(data[pos])
+        pos += 1
+        if key == "e":
+            if pos + 4 > len(data):
+                raise ValueError("Truncated .bit header")
+            fields["length"] = struct.unpack(">I", data[pos:pos + 4])[0]
+            return fields, pos + 4
+        if key not in "abcd" or pos + 2 > len(data):
+            raise ValueError(f"Unexpected field {key!r} in .bit header")
+        length = struct.unpack(">H", data[pos:pos + 2])[0]
+        pos += 2
+        fields[key] = data[pos:pos + length].rstrip(b"\x00").decode("ascii", errors="replace")
+        pos += length
+
+    raise ValueError("Truncated .bit header")
+
+
+def parse_design_field(value):
+    """
+    Splits "top;UserID=0XFFFFFFFF;Version=2022.2" into the design name and
+    its attributes.
+    """
+    parts = value.split(";")
+    attributes = {}
+    for item in parts[1:]:
+        if "=" in item:
+            key, val = item.split("=", 1)
+            attributes[key] = val
+    return parts[0], attributes
+
+
+def parse_config_stream(data):
+    """
+    Finds the sync word and the IDCODE written by the configuration stream.
+    """
+    sync_offset = data.find(SYNC_WORD)
+    if sync_offset < 0:
+        raise ValueError("Sync word 0xAA995566 not found in configuration data")
+
+    idcode = None
+    idcode_offset = data.find(IDCODE_WRITE, sync_offset)
+    if idcode_offset >= 0 and idcode_offset + 8 <= len(data):
+        idcode = struct.unpack(">I", data[idcode_offset + 4:idcode_offset + 8])[0]
+    return sync_offset, idcode
+
+
+def parse_bitstream(path):
+    """
+    Returns the metadata of a .bit or .bin file. Raises ValueError if the
+    file is not a valid configuration image.
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        data = f.read(SCAN_BYTES)
+
+    meta = {"size": size}
+    if data.startswith(BIT_HEADER_MAGIC):
+        fields, data_offset = parse_bit_header(data)
+        design, attributes = parse_design_field(fields.get("a", ""))
+        meta.update({
+            "format": "bit",
+            "design": design,
+            "attributes": attributes,
+            "part": fields.get("b"),
+            "date": fields.get("c"),
+            "time": fields.get("d"),
+            "length": fields["length"],
+        })
+        if data_offset + fields["length"] != size:
+            raise ValueError(
+                f"Bitstream length {fields['length']} does not match file size "
+                f"({size - data_offset} bytes after header)"
+            )
+        data = data[data_offset:]
+    else:
+        meta.update({
+            "format": "bin",
+            "design": None,
+            "attributes": {},
+            "part": None,
+            "date": None,
+            "time": None,
+            "length": size,
+        })
+
+    sync_offset, idcode = parse_config_stream(data)
+    meta["sync_offset"] = sync_offset
+    meta["idcode"] = f"0x{idcode:08X}" if idcode is not None else None
+
+    # .bin files carry no header, so their part comes from the IDCODE
+    if meta["part"] is None and idcode is not None:
+        meta["part"] = IDCODE_PARTS.get(idcode & 0x0FFFFFFF)
+
+    return meta
+
+
+def get_bitstream_metadata(path):
+    """
+    Returns the parsed metadata of path, cached by content hash so the same
+    image is only parsed once.
+    """
+    digest = file_sha256(path)
+    with metadata_lock:
+        cached = metadata_cache.get(digest)
+    if cached:
+        return cached
+
+    meta = parse_bitstream(path)
+    meta["sha256"] = digest
+    with metadata_lock:
+        metadata_cache[digest] = meta
+    return meta
+
+
+def is_partial(meta):
+    return meta.get("attributes", {}).get("PARTIAL", "").upper() == "TRUE"
+
+
+def needs_clearing_bitstream(part):
+    """
+    UltraScale (not UltraScale+) devices must load the clearing bitstream
+    of a reconfigurable partition before a new partial image is programmed.
+    """
+    return bool(part) and re.match(r"xc(ku|vu)\d+(-|$)", part.lower()) is not None
+
+
+def check_targets(meta, targets):
+    """
+    Returns a list of error messages for targets whose configured device
+    does not match the part the image was built for.
+    """
+    part = meta.get("part")
+    if not part:
+        return []
+
+    errors = []
+    for t in targets:
+        if not part.lower().startswith(t["device"].lower()):
+            errors.append(f"Image is built for {part}, but target {t['target']} is a {t['device']}")
+    return errors
+
+
+def describe(meta):
+    return (
+        f"Bitstream: design {meta['design'] or '-'}, part {meta['part'] or 'unknown'}, "
+        f"built {meta['date'] or '-'} {meta['time'] or ''}".rstrip()
+        + f", {meta['length']} bytes, sync word at {meta['sync_offset']}, IDCODE {meta['idcode'] or '-'}\n"
+    )
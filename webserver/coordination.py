@@ -0,0 +1,477 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import socket
+import sqlite3
+import threading
+import traceback
+import subprocess
+import contextlib
+
+import metrics
+
+# ==============================
+# Configuration
+# ==============================
+# Jobs, cable locks, worker leases and job output live in a local SQLite
+# database so that several server processes can share them: any process
+# can accept a job, the first idle worker (in any process) whose cables are
+# free runs it, and any process can stream its output.
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../"))
+DB_PATH = os.path.join(BASE_DIR, "coordination.sqlite3")
+
+LEASE_SECONDS = 30           # a running job is abandoned if its lease is not renewed
+POLL_INTERVAL = 0.2          # seconds between queue / output polls
+RETENTION_SECONDS = 24 * 3600
+
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+HEARTBEAT_RETRY_SECONDS = 1  # delay before retrying a failed lease renewal
+
+FINISHED_STATES = ("done", "failed")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    cables TEXT NOT NULL,
+    state TEXT NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, kind);
+CREATE TABLE IF NOT EXISTS job_output (
+    job_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    item TEXT NOT NULL,
+    PRIMARY KEY (job_id, seq)
+);
+"""
+
+
+# ==============================
+# Database
+# ==============================
+
+def connect():
+    conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA busy_timeout = 30000")
+    return conn
+
+
+def init_db():
+    conn = connect()
+    try:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.executescript(SCHEMA)
+    finally:
+        conn.close()
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Exclusive advisory lock on path + ".lock", held across threads and
+    processes, e.g. while rewriting a shared config file.
+    """
+    with open(path + ".lock", "w") as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+# ==============================
+# Cable locking
+# ==============================
+
+def get_cables(targets):
+    """
+    Lock keys of the cables behind targets. A cable is named by its target
+    path (e.g. "xilinx_tcf/Digilent/<serial>") without the hw_server
+    address, because the same cable can be reached through several
+    hw_servers.
+    """
+    return [t["target"] for t in targets]
+
+
+def cables_conflict(cables, held):
+    """
+    Two jobs conflict when they share a cable.
+    """
+    return not set(cables).isdisjoint(held)
+
+
+# ==============================
+# Jobs
+# ==============================
+
+def submit(kind, payload, cables):
+    """
+    Queues a job and returns its id.
+    """
+    conn = connect()
+    try:
+        cursor = conn.execute(
+            "INSERT INTO jobs (kind, payload, cables, state, created) VALUES (?, ?, ?, 'queued', ?)",
+            (kind, json.dumps(payload), json.dumps(cables), time.time()),
+        )
+        return cursor.lastrowid
+    finally:
+        conn.close()
+
+
+def append_output(conn, job_id, item):
+    conn.execute(
+        "INSERT INTO job_output (job_id, seq, item) "
+        "SELECT ?, COALESCE(MAX(seq), 0) + 1, ? FROM job_output WHERE job_id = ?",
+        (job_id, json.dumps(item), job_id),
+    )
+
+
+def append_job_output(conn, lease, item):
+    """
+    Appends output of the job this worker runs, unless the job was reaped
+    meanwhile. Returns False (and gives up the lease) if it was.
+    """
+    if lease.lost.is_set():
+        return False
+    cursor = conn.execute(
+        "INSERT INTO job_output (job_id, seq, item) "
+        "SELECT ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM job_output WHERE job_id = ?), ? "
+        "WHERE EXISTS (SELECT 1 FROM jobs WHERE id = ? AND state = 'running' AND worker = ?)",
+        (lease.job_id, lease.job_id, json.dumps(item), lease.job_id, WORKER_ID),
+    )
+    if cursor.rowcount == 0:
+        lease.lose()
+        return False
+    return True
+
+
+def reap_expired(conn):
+    """
+    Fails running jobs whose worker stopped renewing its lease, which
+    releases their cables. Must be called inside a write transaction.
+    """
+    now = time.time()
+    expired = conn.execute(
+        "SELECT id, worker FROM jobs WHERE state = 'running' AND lease_expires < ?", (now,)
+    ).fetchall()
+    for job_id, worker in expired:
+        append_output(conn, job_id, {"type": "log",
+                                     "line": f"\n===== Worker {worker} lost, job abandoned =====\n"})
+        conn.execute("UPDATE jobs SET state = 'failed', finished = ? WHERE id = ?", (now, job_id))
+
+    conn.execute("DELETE FROM job_output WHERE job_id IN "
+                 "(SELECT id FROM jobs WHERE finished < ?)", (now - RETENTION_SECONDS,))
+    conn.execute("DELETE FROM jobs WHERE finished < ?", (now - RETENTION_SECONDS,))
+
+
+def claim_job(kind):
+    """
+    Leases the oldest queued job of this kind whose cables are free. Cables
+    of running jobs and of older queued jobs count as taken, so jobs on the
+    same cable run in submission order. Returns None if nothing can run.
+    """
+    conn = connect()
+    try:
+        if conn.execute("SELECT 1 FROM jobs WHERE state = 'queued' AND kind = ? LIMIT 1",
+                        (kind,)).fetchone() is None:
+            return None
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            reap_expired(conn)
+            held = []
+            for (cables,) in conn.execute("SELECT cables FROM jobs WHERE state = 'running'"):
+                held.extend(json.loads(cables))
+
+            queued = conn.execute(
+                "SELECT id, kind, payload, cables, created FROM jobs WHERE state = 'queued' ORDER BY id"
+            ).fetchall()
+            for job_id, job_kind, payload, cables, created in queued:
+                cables = json.loads(cables)
+                if job_kind == kind and not cables_conflict(cables, held):
+                    now = time.time()
+                    conn.execute(
+                        "UPDATE jobs SET state = 'running', worker = ?, lease_expires = ?, started = ? "
+                        "WHERE id = ?",
+                        (WORKER_ID, now + LEASE_SECONDS, now, job_id),
+                    )
+                    conn.execute("COMMIT")
+                    return {"id": job_id, "payload": json.loads(payload),
+                            "created": created, "started": now}
+                held.extend(cables)
+
+            conn.execute("COMMIT")
+            return None
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+
+
+def renew_lease(job_id):
+    """
+    Extends the lease of a running job. Returns False if this worker no
+    longer holds it, e.g. because the job was reaped.
+    """
+    conn = connect()
+    try:
+        cursor = conn.execute(
+            "UPDATE jobs SET lease_expires = ? WHERE id = ? AND worker = ? AND state = 'running'",
+            (time.time() + LEASE_SECONDS, job_id, WORKER_ID),
+        )
+        return cursor.rowcount > 0
+    finally:
+        conn.close()
+
+
+def finish(conn, job_id, state):
+    conn.execute("UPDATE jobs SET state = ?, finished = ? WHERE id = ? AND worker = ? AND state = 'running'",
+                 (state, time.time(), job_id, WORKER_ID))
+
+
+def queue_depth(kind):
+    conn = connect()
+    try:
+        return conn.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND kind = ?",
+                            (kind,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def stream_output(job_id):
+    """
+    Yields the output items of a job, from whichever process runs it,
+    until the job has finished.
+    """
+    conn = connect()
+    last_seq = 0
+    try:
+        while True:
+            job = conn.execute("SELECT state, lease_expires FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            rows = conn.execute(
+                "SELECT seq, item FROM job_output WHERE job_id = ? AND seq > ? ORDER BY seq",
+                (job_id, last_seq),
+            ).fetchall()
+            for seq, item in rows:
+                last_seq = seq
+                yield json.loads(item)
+
+            if rows:
+                continue
+            if job is None or job[0] in FINISHED_STATES:
+                return
+            if job[0] == "running" and job[1] < time.time():
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    reap_expired(conn)
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+                continue
+            time.sleep(POLL_INTERVAL)
+    finally:
+        conn.close()
+
+
+# ==============================
+# Leases
+# ==============================
+
+_current = threading.local()
+
+
+class Lease:
+    """
+    Lease of the job a worker thread runs. Subprocesses registered with
+    register_process are terminated when the lease is lost, i.e. when
+    another process reaped the job and may already run the next one on the
+    same cables.
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.lost = threading.Event()
+        self.processes = []
+        self.lock = threading.Lock()
+
+    def add_process(self, process):
+        with self.lock:
+            self.processes.append(process)
+            lost = self.lost.is_set()
+        if lost:
+            process.terminate()
+
+    def lose(self):
+        with self.lock:
+            self.lost.set()
+            processes = list(self.processes)
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+
+    def release(self):
+        """
+        Called when the job ends: stops and reaps subprocesses still running.
+        """
+        with self.lock:
+            processes = list(self.processes)
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+            try:
+                process.wait(timeout=LEASE_SECONDS)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+
+def current_job_id():
+    """
+    Id of the job run by the current worker thread (the "job_id" clients
+    receive), or None outside a worker.
+    """
+    lease = getattr(_current, "lease", None)
+    return lease.job_id if lease is not None else None
+
+
+def register_process(process):
+    """
+    Ties a subprocess (e.g. vivado_lab) to the job run by the current worker
+    thread, so it is terminated if the job's lease is lost.
+    """
+    lease = getattr(_current, "lease", None)
+    if lease is not None:
+        lease.add_process(process)
+
+
+# ==============================
+# Workers
+# ==============================
+
+def finish_job(job_id, state):
+    """
+    Stores the final state of a job, retrying on database errors for as long
+    as the lease would have lasted. If it never succeeds, the job is reaped
+    as failed once its lease expires.
+    """
+    deadline = time.time() + LEASE_SECONDS
+    while True:
+        try:
+            conn = connect()
+            try:
+                finish(conn, job_id, state)
+            finally:
+                conn.close()
+            return True
+        except sqlite3.Error:
+            traceback.print_exc()
+            if time.time() >= deadline:
+                return False
+            time.sleep(HEARTBEAT_RETRY_SECONDS)
+
+
+def run_job(kind, handler, job):
+    """
+    Runs one claimed job: stores every item yielded by handler(payload) as
+    job output while a heartbeat renews the lease. If the lease is lost, or
+    output can no longer be stored, the job is abandoned.
+    """
+    metrics.record_queue_wait(kind, job["started"] - job["created"])
+    metrics.worker_busy.set(1, job=kind)
+
+    stop = threading.Event()
+    lease = Lease(job["id"])
+
+    def heartbeat():
+        delay = LEASE_SECONDS / 3
+        while not stop.wait(delay):
+            try:
+                renewed = renew_lease(lease.job_id)
+            except sqlite3.Error:
+                # The lease is still valid for a while; try again soon
+                delay = HEARTBEAT_RETRY_SECONDS
+                continue
+            if not renewed:
+                lease.lose()
+                return
+            delay = LEASE_SECONDS / 3
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+
+    conn = None
+    _current.lease = lease
+    items = None
+    state = "done"
+    try:
+        conn = connect()
+        items = handler(job["payload"])
+        for item in items:
+            if not append_job_output(conn, lease, item):
+                break
+    except sqlite3.Error:
+        # The output can't be stored, so nobody would see the rest of the job
+        state = "failed"
+        traceback.print_exc()
+    except Exception as e:
+        state = "failed"
+        try:
+            append_job_output(conn, lease, {"type": "log",
+                                            "line": f"\n===== Worker Exception =====\n{str(e)}\n"})
+        except sqlite3.Error:
+            traceback.print_exc()
+    finally:
+        try:
+            if items is not None:
+                items.close()
+        except Exception:
+            traceback.print_exc()
+        stop.set()
+        _current.lease = None
+        lease.release()
+        finish_job(job["id"], state)
+        if conn is not None:
+            conn.close()
+        metrics.worker_busy.set(0, job=kind)
+        metrics.worker_busy_seconds_total.inc(time.time() - job["started"], job=kind)
+
+
+def run_worker(kind, handler):
+    """
+    Worker loop: claims jobs of this kind and runs them one at a time. Errors
+    of a single job are logged and never stop the loop.
+    """
+    while True:
+        try:
+            job = claim_job(kind)
+        except sqlite3.Error:
+            job = None
+        if job is None:
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        try:
+            run_job(kind, handler, job)
+        except Exception:
+            traceback.print_exc()
+
+
+def start_worker(kind, handler):
+    metrics.worker_busy.set(0, job=kind)
+    metrics.queue_depth.set_function(lambda: queue_depth(kind), job=kind)
+    threading.Thread(target=run_worker, args=(kind, handler), daemon=True).start()
+
+
+init_db()
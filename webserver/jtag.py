@@ -0,0 +1,149 @@
+import os
+import json
+import textwrap
+
+import coordination
+
+# ==============================
+# JTAG clock frequencies
+# ==============================
+# Targets in programming_servers.json may carry a calibrated "jtag_frequency"
+# (see xilinx_tests.stream_jtag_calibration). Programming scripts apply it
+# before opening the target and retry once at the next lower standard rate
+# if the JTAG chain fails at the tuned one.
+
+# Same file as app.CONFIG_PATH
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), "config/programming_servers.json")
+
+# TCK rates offered by Digilent/Xilinx cables, fastest first
+STANDARD_FREQUENCIES = [
+    30000000, 15000000, 10000000, 7500000, 6000000, 5000000,
+    3750000, 3000000, 2500000, 2000000, 1000000, 500000, 250000, 125000,
+]
+
+
+# Runs a JTAG chain command (open, IDCODE/status reads, bitstream transfer)
+# in the caller's scope and prefixes its errors with "JTAG: ", which marks
+# them as worth a retry at a lower TCK rate.
+TCL_JTAG_PROC = (
+    "proc __jtag {script} {\n"
+    "    if {[catch {uplevel 1 $script} result]} {\n"
+    "        error \"JTAG: $result\"\n"
+    "    }\n"
+    "}\n\n"
+)
+
+
+def get_fallback_frequency(frequency):
+    for f in STANDARD_FREQUENCIES:
+        if f < frequency:
+            return f
+    return None
+
+
+def get_frequency_attempts(target):
+    """
+    Returns the TCK rates to try for a target, as a TCL list: the calibrated
+    rate followed by its fallback, or an empty list to keep the cable default.
+    """
+    frequency = target.get("jtag_frequency")
+    if not frequency:
+        return "{}"
+    attempts = [frequency]
+    fallback = get_fallback_frequency(frequency)
+    if fallback:
+        attempts.append(fallback)
+    return "{" + " ".join(str(f) for f in attempts) + "}"
+
+
+def generate_tcl_chain_command(command, indent="        "):
+    """
+    Returns a TCL block running command through __jtag (see TCL_JTAG_PROC).
+    The command keeps its own line so that the profiler still times it.
+    """
+    return (
+        f"{indent}__jtag {{\n"
+        f"{indent}    {command}\n"
+        f"{indent}}}\n"
+    )
+
+
+def generate_tcl_target_attempts(target_body, error_message):
+    """
+    Wraps the per-target body of a programming script (indented for the
+    target loop's `catch`) in a loop over the target's JTAG frequencies.
+    Expects $target_info to hold {target_path device_name frequencies} and
+    TCL_JTAG_PROC at the top of the script. Only JTAG chain errors are
+    retried at the next lower rate; any other error, or the last failure,
+    prints "<error_message>: $err". When a retry succeeds, the rate that
+    worked is reported as "#JTAG_FALLBACK <target> <frequency>".
+    """
+    return (
+        "    set jtag_freqs [lindex $target_info 2]\n"
+        "    if {$jtag_freqs eq {}} { set jtag_freqs [list {}] }\n\n"
+        "    for {set attempt 0} {$attempt < [llength $jtag_freqs]} {incr attempt} {\n"
+        "        set jtag_freq [lindex $jtag_freqs $attempt]\n"
+        "        if {![catch {\n"
+        "            if {$jtag_freq ne {}} {\n"
+        "                puts \"JTAG frequency: $jtag_freq Hz\"\n"
+        "                set_property PARAM.FREQUENCY $jtag_freq [get_hw_targets $target_path]\n"
+        "            }\n\n"
+        + textwrap.indent(target_body, "    ") +
+        "        } err]} {\n"
+        "            if {$attempt > 0} {\n"
+        "                puts \"#JTAG_FALLBACK $target_path $jtag_freq\"\n"
+        "            }\n"
+        "            break\n"
+        "        }\n\n"
+        "        catch { close_hw_target $target_path -quiet }\n"
+        "        if {[string match \"JTAG: *\" $err] && $attempt + 1 < [llength $jtag_freqs]} {\n"
+        "            set next_freq [lindex $jtag_freqs [expr {$attempt + 1}]]\n"
+        "            puts \"JTAG failure at $jtag_freq Hz, retrying at $next_freq Hz: $err\"\n"
+        "        } else {\n"
+        f"            puts \"{error_message}: $err\"\n"
+        "            break\n"
+        "        }\n"
+        "    }\n"
+    )
+
+
+def parse_fallback(line, hw_server):
+    """
+    Turns a "#JTAG_FALLBACK <target_path> <frequency>" line, printed once a
+    retry at the lower rate succeeded, into a stream item so that rate can
+    be stored for the target.
+    """
+    parts = line.split()
+    if len(parts) != 3 or parts[0] != "#JTAG_FALLBACK":
+        return None
+    return {
+        "type": "jtag_fallback",
+        "hw_server": hw_server,
+        "target": parts[1][len(hw_server) + 1:] if parts[1].startswith(hw_server + "/") else parts[1],
+        "frequency": int(parts[2]),
+    }
+
+
+def save_frequency(hw_server, target_name, frequency):
+    """
+    Stores a calibrated (or fallen back) JTAG clock for a target in the
+    server configuration, where the programming tabs pick it up. Called by
+    the workers themselves, so results are kept even if no client is
+    streaming the job.
+    """
+    with coordination.file_lock(CONFIG_PATH):
+        if not os.path.exists(CONFIG_PATH):
+            return
+        with open(CONFIG_PATH) as f:
+            config = json.load(f)
+        for s in config.get("xilinx_hw_servers", []):
+            if s["address"] != hw_server:
+                continue
+            for t in s.get("targets", []):
+                if t["target"] == target_name:
+                    t["jtag_frequency"] = frequency
+
+        tmp_path = CONFIG_PATH + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(config, f, indent=2)
+        os.replace(tmp_path, CONFIG_PATH)
@@ -0,0 +1,352 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+# ==============================
+# Prometheus-style metrics
+# ==============================
+# Minimal counters, gauges and histograms rendered in the Prometheus text
+# exposition format for the /metrics endpoint.
+#
+# Jobs are shared between server processes (see coordination.py), and a
+# scrape may reach any of them, so values are kept in a SQLite database
+# shared by all processes: every process reports lab-wide totals. Counters
+# and histograms are added up across processes. Gauges are stored per
+# process and summed over the processes still alive. Metric updates are
+# best effort and never fail a job.
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../"))
+DB_PATH = os.path.join(BASE_DIR, "metrics.sqlite3")
+
+DEFAULT_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# pid of rows shared by all processes (counters, histograms)
+SHARED_PID = 0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metric_values (
+    metric TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    sample TEXT NOT NULL,
+    le TEXT NOT NULL,
+    pid INTEGER NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (metric, labels, sample, le, pid)
+);
+"""
+
+UPSERT_ADD = (
+    "INSERT INTO metric_values (metric, labels, sample, le, pid, value) VALUES (?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT (metric, labels, sample, le, pid) DO UPDATE SET value = value + excluded.value"
+)
+UPSERT_SET = (
+    "INSERT INTO metric_values (metric, labels, sample, le, pid, value) VALUES (?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT (metric, labels, sample, le, pid) DO UPDATE SET value = excluded.value"
+)
+
+_registry = []
+_lock = threading.Lock()
+
+
+# ==============================
+# Storage
+# ==============================
+
+def connect():
+    conn = sqlite3.connect(DB_PATH, timeout=5, isolation_level=None)
+    conn.execute("PRAGMA busy_timeout = 5000")
+    return conn
+
+
+def init_db():
+    conn = connect()
+    try:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.executescript(SCHEMA)
+    finally:
+        conn.close()
+
+
+def _write(statements):
+    """
+    Applies (sql, params) pairs in one transaction. Errors are swallowed:
+    a busy database costs a sample, not the job that reports it.
+    """
+    try:
+        conn = connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for sql, params in statements:
+                conn.execute(sql, params)
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        pass
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _prune_dead_processes(conn):
+    """
+    Drops the gauge values of server processes that have exited.
+    """
+    pids = [pid for (pid,) in conn.execute(
+        "SELECT DISTINCT pid FROM metric_values WHERE pid != ?", (SHARED_PID,))]
+    for pid in pids:
+        if not _process_alive(pid):
+            conn.execute("DELETE FROM metric_values WHERE pid = ?", (pid,))
+
+
+# ==============================
+# Metric types
+# ==============================
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        with _lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        return json.dumps([str(labels.get(name, "")) for name in self.label_names])
+
+    def _stored(self, conn):
+        """
+        Returns {(labels, sample, le): value} summed over processes.
+        """
+        rows = conn.execute(
+            "SELECT labels, sample, le, SUM(value) FROM metric_values WHERE metric = ? "
+            "GROUP BY labels, sample, le",
+            (self.name,),
+        ).fetchall()
+        return {(labels, sample, le): value for labels, sample, le, value in rows}
+
+    def samples(self, conn):
+        return [(self.name, tuple(json.loads(labels)), (), value)
+                for (labels, _, _), value in sorted(self._stored(conn).items())]
+
+    def render(self, conn):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, extra, value in self.samples(conn):
+            lines.append(f"{name}{_format_labels(self.label_names, key, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        _write([(UPSERT_ADD, (self.name, self._key(labels), "", "", SHARED_PID, amount))])
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self.callbacks = {}
+
+    def set(self, value, **labels):
+        _write([(UPSERT_SET, (self.name, self._key(labels), "", "", os.getpid(), value))])
+
+    def inc(self, amount=1, **labels):
+        _write([(UPSERT_ADD, (self.name, self._key(labels), "", "", os.getpid(), amount))])
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, func, **labels):
+        """
+        Registers a callable that is evaluated at scrape time, e.g. a queue
+        size read from the shared database. It replaces the stored value.
+        """
+        with _lock:
+            self.callbacks[self._key(labels)] = func
+
+    def samples(self, conn):
+        values = {labels: value for (labels, _, _), value in self._stored(conn).items()}
+        with _lock:
+            callbacks = dict(self.callbacks)
+        for key, func in callbacks.items():
+            values[key] = func()
+        return [(self.name, tuple(json.loads(key)), (), value) for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        statements = [
+            (UPSERT_ADD, (self.name, key, "_bucket", _format_value(bound), SHARED_PID, 1))
+            for bound in self.buckets if value <= bound
+        ]
+        statements.append((UPSERT_ADD, (self.name, key, "_sum", "", SHARED_PID, value)))
+        statements.append((UPSERT_ADD, (self.name, key, "_count", "", SHARED_PID, 1)))
+        _write(statements)
+
+    def samples(self, conn):
+        stored = self._stored(conn)
+        result = []
+        for key in sorted({labels for labels, _, _ in stored}):
+            values = tuple(json.loads(key))
+            for bound in self.buckets:
+                le = _format_value(bound)
+                result.append((f"{self.name}_bucket", values, (("le", le),), stored.get((key, "_bucket", le), 0)))
+            result.append((f"{self.name}_sum", values, (), stored.get((key, "_sum", ""), 0)))
+            result.append((f"{self.name}_count", values, (), stored.get((key, "_count", ""), 0)))
+        return result
+
+
+def render():
+    with _lock:
+        metrics = list(_registry)
+    conn = connect()
+    try:
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            _prune_dead_processes(conn)
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+        return "\n".join(metric.render(conn) for metric in metrics) + "\n"
+    finally:
+        conn.close()
+
+
+init_db()
+
+
+# ==============================
+# Job metrics
+# ==============================
+
+job_phase_seconds = Histogram(
+    "fpga_job_phase_seconds",
+    "Time spent in each phase of a programming job.",
+    labels=("job", "phase"),
+)
+job_duration_seconds = Histogram(
+    "fpga_job_duration_seconds",
+    "Total time from job start to Vivado exit, excluding queue wait.",
+    labels=("job",),
+)
+jobs_total = Counter(
+    "fpga_jobs_total",
+    "Jobs processed by the workers.",
+    labels=("job", "status"),
+)
+target_failures_total = Counter(
+    "fpga_target_failures_total",
+    "Targets that reported an ERROR during a job.",
+    labels=("job",),
+)
+verify_failures_total = Counter(
+    "fpga_verify_failures_total",
+    "Targets whose flash verification failed.",
+    labels=("job",),
+)
+queue_depth = Gauge(
+    "fpga_job_queue_depth",
+    "Jobs waiting in the shared queue.",
+    labels=("job",),
+)
+active_sessions = Gauge(
+    "fpga_active_sessions",
+    "Client requests currently queued or streaming output.",
+    labels=("job",),
+)
+worker_busy = Gauge(
+    "fpga_worker_busy",
+    "Workers currently running a job, across all server processes.",
+    labels=("job",),
+)
+worker_busy_seconds_total = Counter(
+    "fpga_worker_busy_seconds_total",
+    "Cumulative time the worker spent running jobs; rate() gives utilization.",
+    labels=("job",),
+)
+upload_bytes_total = Counter(
+    "fpga_upload_bytes_total",
+    "Bytes of uploaded programming files.",
+    labels=("kind",),
+)
+
+
+class PhaseTimer:
+    """
+    Times the phases of one job. Phase boundaries come from the `puts`
+    markers in the generated TCL: `markers` maps a line prefix to the phase
+    that starts there, or to None when the line only ends the current phase.
+    """
+
+    def __init__(self, job, markers):
+        self.job = job
+        self.markers = markers
+        self.phase = None
+        self.phase_start = None
+
+    def start(self, phase):
+        self.stop()
+        self.phase = phase
+        self.phase_start = time.monotonic()
+
+    def stop(self):
+        if self.phase is not None:
+            job_phase_seconds.observe(time.monotonic() - self.phase_start,
+                                      job=self.job, phase=self.phase)
+        self.phase = None
+        self.phase_start = None
+
+    def feed(self, line):
+        stripped = line.strip()
+        for prefix, phase in self.markers.items():
+            if stripped.startswith(prefix):
+                if phase is None:
+                    self.stop()
+                else:
+                    self.start(phase)
+                return
+
+
+def record_queue_wait(job, seconds):
+    job_phase_seconds.observe(seconds, job=job, phase="queue_wait")
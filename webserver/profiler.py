@@ -0,0 +1,133 @@
+import os
+import re
+import json
+
+# ==============================
+# Configuration
+# ==============================
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../"))
+PROFILE_FOLDER = os.path.join(BASE_DIR, "profiles")
+
+os.makedirs(PROFILE_FOLDER, exist_ok=True)
+
+# Only hardware commands and property writes are timed; control flow,
+# `set` and `puts` lines are left untouched.
+PROFILED_COMMAND = re.compile(r"^(\w*_hw_\w*|set_property|startgroup|endgroup)\b")
+SKIPPED_COMMANDS = {"get_hw_devices", "get_hw_targets"}
+
+# Runs a command in the caller's scope and prints
+# "#PROF <target> <start_us> <end_us> <rc> <label>". The "#" prefix keeps the
+# line out of the web console while it still lands in the log file.
+TCL_PROFILE_PROC = (
+    "proc __prof {label script} {\n"
+    "    global target_path\n"
+    "    set target [expr {[info exists target_path] ? $target_path : \"-\"}]\n"
+    "    set start [clock microseconds]\n"
+    "    set rc [catch {uplevel 1 $script} result options]\n"
+    "    puts \"#PROF $target $start [clock microseconds] $rc $label\"\n"
+    "    return -options $options $result\n"
+    "}\n\n"
+)
+
+
+# ==============================
+# TCL instrumentation
+# ==============================
+
+def get_label(command):
+    words = command.split()
+    if words[0] == "set_property" and len(words) > 1:
+        return f"set_property {words[1]}"
+    return words[0]
+
+
+def instrument_tcl(tcl_script):
+    """
+    Wraps every single-line hardware command of a generated TCL script in
+    __prof so that the job output carries a timestamp pair per command.
+    """
+    lines = []
+    for line in tcl_script.splitlines(keepends=True):
+        command = line.strip()
+        match = PROFILED_COMMAND.match(command)
+        if (
+            match
+            and match.group(1) not in SKIPPED_COMMANDS
+            and command.count("{") == command.count("}")
+            and not command.endswith("\\")
+        ):
+            indent = line[:len(line) - len(line.lstrip())]
+            line = f"{indent}__prof {{{get_label(command)}}} {{{command}}}\n"
+        lines.append(line)
+
+    return TCL_PROFILE_PROC + "".join(lines)
+
+
+# ==============================
+# Profile collection
+# ==============================
+
+class ProfileCollector:
+    """
+    Collects the "#PROF" lines of one job and builds a per-target timing
+    breakdown relative to the first profiled command.
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.entries = []
+
+    def feed(self, line):
+        stripped = line.strip()
+        if not stripped.startswith("#PROF "):
+            return
+        parts = stripped.split(maxsplit=5)
+        if len(parts) != 6:
+            return
+        _, target, start, end, rc, label = parts
+        self.entries.append({
+            "target": target,
+            "command": label,
+            "start_us": int(start),
+            "end_us": int(end),
+            "ok": rc == "0",
+        })
+
+    def result(self):
+        origin = min((e["start_us"] for e in self.entries), default=0)
+        targets = {}
+        for e in self.entries:
+            target = targets.setdefault(e["target"], {"target": e["target"], "commands": [], "totals": {}})
+            duration_ms = (e["end_us"] - e["start_us"]) / 1000.0
+            target["commands"].append({
+                "command": e["command"],
+                "start_ms": (e["start_us"] - origin) / 1000.0,
+                "duration_ms": duration_ms,
+                "ok": e["ok"],
+            })
+            target["totals"][e["command"]] = target["totals"].get(e["command"], 0.0) + duration_ms
+
+        return {"job_id": self.job_id, "targets": list(targets.values())}
+
+
+def get_profile_path(job_id):
+    return os.path.join(PROFILE_FOLDER, f"{int(job_id)}.json")
+
+
+def save_profile(profile):
+    """
+    Stores a profile under the coordination job id it was collected for.
+    """
+    profile_path = get_profile_path(profile["job_id"])
+    with open(profile_path, "w") as f:
+        json.dump(profile, f, indent=2)
+    return profile_path
+
+
+def load_profile(job_id):
+    profile_path = get_profile_path(job_id)
+    if not os.path.exists(profile_path):
+        return None
+    with open(profile_path) as f:
+        return json.load(f)
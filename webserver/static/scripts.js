@@ -5,17 +5,20 @@ const hwServerSelect = document.getElementById("hw_server");
 const hiddenFpga = document.getElementById("hidden_hw_server_fpga");
 const hiddenFlash = document.getElementById("hidden_hw_server_flash");
 const hiddenTests = document.getElementById("hidden_hw_server_tests");
+const hiddenCalibrate = document.getElementById("hidden_hw_server_calibrate");
 
 // Initialize hidden fields with first selection
 hiddenFpga.value = hwServerSelect.value;
 hiddenFlash.value = hwServerSelect.value;
 hiddenTests.value = hwServerSelect.value;
+hiddenCalibrate.value = hwServerSelect.value;
 
 // Update hidden fields when drop-down changes
 hwServerSelect.addEventListener("change", () => {
   hiddenFpga.value = hwServerSelect.value;
   hiddenFlash.value = hwServerSelect.value;
   hiddenTests.value = hwServerSelect.value;
+  hiddenCalibrate.value = hwServerSelect.value;
 
   loadTargetsForServer(hwServerSelect.value);
   loadFlashTargetsForServer(hwServerSelect.value);
@@ -24,13 +27,17 @@ hwServerSelect.addEventListener("change", () => {
 // ==========================
 // Stream form submission to output (with optional JSON callback)
 // ==========================
-function streamForm(formId, outputId, url, jsonCallback = null) {
+// clearIds: elements filled by jsonCallback, emptied on every submit
+function streamForm(formId, outputId, url, jsonCallback = null, clearIds = []) {
   const form = document.getElementById(formId);
   const output = document.getElementById(outputId);
 
   form.addEventListener("submit", async (e) => {
     e.preventDefault();
     output.textContent = "";
+    for (const id of clearIds) {
+      document.getElementById(id).innerHTML = "";
+    }
 
     const formData = new FormData(form);
     const response = await fetch(url, { method: "POST", body: formData });
@@ -120,16 +127,81 @@ function renderTree(tree) {
   });
 }
 
+// ==========================
+// Per-command TCL profile timeline
+// ==========================
+function renderProfile(profile, containerId) {
+  const container = document.getElementById(containerId);
+  const colors = ["#0d6efd", "#198754", "#fd7e14", "#6f42c1", "#d63384", "#20c997", "#ffc107", "#6c757d"];
+  const colorFor = {};
+  let nextColor = 0;
+
+  let end = 0;
+  for (const t of profile.targets) {
+    for (const c of t.commands) {
+      end = Math.max(end, c.start_ms + c.duration_ms);
+    }
+  }
+
+  let html = `<h5>Profile <small class="text-muted">job ${profile.job_id}</small></h5>`;
+  for (const t of profile.targets) {
+    html += `<div class="mt-2"><b>${t.target}</b></div>`;
+    html += `<div class="border bg-light" style="position: relative; height: 24px;">`;
+    for (const c of t.commands) {
+      if (!(c.command in colorFor)) {
+        colorFor[c.command] = colors[nextColor++ % colors.length];
+      }
+      const left = end ? (100 * c.start_ms) / end : 0;
+      const width = end ? Math.max((100 * c.duration_ms) / end, 0.2) : 0;
+      const border = c.ok ? "" : "outline: 2px solid red;";
+      html += `<div title="${c.command}: ${c.duration_ms.toFixed(1)} ms"
+                    style="position: absolute; top: 2px; bottom: 2px; left: ${left}%; width: ${width}%;
+                           background: ${colorFor[c.command]}; ${border}"></div>`;
+    }
+    html += "</div>";
+
+    const totals = Object.entries(t.totals).sort((a, b) => b[1] - a[1]);
+    html += `<table class="table table-sm mt-1"><tbody>`;
+    for (const [command, ms] of totals) {
+      html += `<tr><td><span style="color: ${colorFor[command]};">■</span> ${command}</td>
+                   <td class="text-end">${ms.toFixed(1)} ms</td></tr>`;
+    }
+    html += "</tbody></table>";
+  }
+
+  container.innerHTML = html;
+}
+
 // ==========================
 // Attach forms
 // ==========================
-streamForm("fpga-form", "fpga-output", "/program_fpga");
-streamForm("flash-form", "flash-output", "/program_flash");
+streamForm("fpga-form", "fpga-output", "/program_fpga", (item) => {
+  if (item.type === "profile") {
+    renderProfile(item.profile, "fpga-profile");
+  }
+}, ["fpga-profile"]);
+streamForm("flash-form", "flash-output", "/program_flash", (item) => {
+  if (item.type === "profile") {
+    renderProfile(item.profile, "flash-profile");
+  }
+}, ["flash-profile"]);
 streamForm("tests-form", "tests-output", "/list_hw", (item) => {
   if (item.type === "tree") {
     renderTree(item.tree);
   }
 });
+streamForm("calibrate-form", "tests-output", "/calibrate_jtag", (item) => {
+  if (item.type === "jtag_calibration") {
+    loadTargetsForServer(hwServerSelect.value);
+    loadFlashTargetsForServer(hwServerSelect.value);
+  }
+});
+
+// Label of a target checkbox, with its calibrated JTAG clock if any
+function targetLabel(t) {
+  const freq = t.jtag_frequency ? ` (TCK ${t.jtag_frequency / 1e6} MHz)` : "";
+  return `${t.target} — ${t.device}${freq}`;
+}
 
 
 // ==========================
@@ -170,7 +242,7 @@ async function loadTargetsForServer(serverAddress) {
              value="${t.target}|${t.device}"
              id="${id}" checked>
       <label class="form-check-label" for="${id}">
-        ${t.target} — ${t.device}
+        ${targetLabel(t)}
       </label>
     `;
 
@@ -220,7 +292,7 @@ async function loadFlashTargetsForServer(serverAddress) {
              value="${t.target}|${t.device}"
              id="${id}" checked>
       <label class="form-check-label" for="${id}">
-        ${t.target} — ${t.device}
+        ${targetLabel(t)}
       </label>
     `;
 
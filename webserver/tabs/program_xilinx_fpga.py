@@ -1,10 +1,15 @@
 import os
-import subprocess
-import queue
-import threading
 import traceback
+import time
 from datetime import datetime
 
+import bitstream
+import coordination
+import jtag
+import metrics
+import profiler
+import vivado_env
+
 # ==============================
 # Configuration
 # ==============================
@@ -22,7 +27,22 @@ os.makedirs(TCL_FOLDER, exist_ok=True)
 VIVADO_SETTINGS = "/tools/Xilinx/Vivado_Lab/2022.2/settings64.sh"
 SCRIPT_NAME = "program-xilinx-fpga"
 
-job_queue = queue.Queue()
+# Job phases timed for /metrics, keyed by the TCL `puts` marker that starts them
+PHASE_MARKERS = {
+    "=== Starting FPGA Programming ===": "hw_server_connect",
+    "Listing all hardware targets": None,
+    "Opening hardware target...": "open_target",
+    "Checking static design...": "static_check",
+    "Programming clearing bitstream...": "clear",
+    "Programming device...": "program",
+    "Programming partial bitstream...": "program",
+    "Refreshing device...": "refresh",
+    "Closing hardware target...": "close_target",
+    "Target programmed successfully.": None,
+    "JTAG failure at": None,
+    "ERROR while programming": None,
+    "=== All targets processed ===": None,
+}
 
 # ==============================
 # Utility
@@ -33,13 +53,45 @@ def allowed_file(filename):
 
 
 def get_timestamp():
-    return datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    return datetime.now().strftime("%Y-%m-%d_%H-%M-%S_%f")
 
 import os
 # ============================== 
 # TCL Generator 
 # ==============================
 
+def generate_tcl_static_check(job_config):
+    """
+    Returns the TCL block that guards partial reconfiguration: the static
+    design currently loaded must report the declared USR_ACCESS value,
+    otherwise the partial bitstream is not programmed on that target. If a
+    clearing bitstream was uploaded, it is programmed right after the check.
+    """
+    if not job_config.get("partial"):
+        return ""
+
+    static_id = job_config["static_id"]
+    block = (
+        "        # --- Check the loaded static design before partial reconfiguration ---\n"
+        "        puts \"Checking static design...\"\n"
+        f"        set static_id 0x{static_id:08X}\n"
+        "        set usr_access [get_property REGISTER.USR_ACCESS $hw_dev]\n"
+        "        puts \"Loaded USR_ACCESS: $usr_access (expected [format %08X $static_id])\"\n"
+        "        if {[scan [regsub {^0[xX]} $usr_access {}] %x loaded_id] != 1 || $loaded_id != $static_id} {\n"
+        "            error \"Static design mismatch: loaded USR_ACCESS $usr_access, expected [format %08X $static_id]\"\n"
+        "        }\n\n"
+    )
+
+    # UltraScale: clear the reconfigurable partition before loading the new image
+    if job_config.get("clear_path"):
+        block += (
+            "        puts \"Programming clearing bitstream...\"\n"
+            f"        set_property PROGRAM.FILE \"{job_config['clear_path']}\" $hw_dev\n"
+            + jtag.generate_tcl_chain_command("program_hw_devices $hw_dev") + "\n"
+        )
+    return block
+
+
 def generate_tcl_script(job_config, timestamp):
     """
     Generates a TCL script to program FPGA targets with proper device selection.
@@ -47,6 +99,8 @@ def generate_tcl_script(job_config, timestamp):
     """
     tcl_filename = f"{SCRIPT_NAME}_{timestamp}.tcl"
     tcl_path = os.path.join(TCL_FOLDER, tcl_filename)
+    static_check_block = generate_tcl_static_check(job_config)
+    program_message = "Programming partial bitstream..." if job_config.get("partial") else "Programming device..."
 
     # Prepare hw_targets, bitfiles, and ltxfiles blocks
     hw_targets_block = ""
@@ -55,44 +109,16 @@ def generate_tcl_script(job_config, timestamp):
 
     for t in job_config["targets"]:
         full_target = f"{job_config['hw_server']}/{t['target']}"
-        hw_targets_block += f'    {{{full_target} {t["device"]}}}\n'
+        hw_targets_block += f'    {{{full_target} {t["device"]} {jtag.get_frequency_attempts(t)}}}\n'
         bitfiles_block += f'    "{job_config["bit_path"]}"\n'
         if job_config.get("ltx_path") and os.path.exists(job_config["ltx_path"]):
             ltxfiles_block += f'    "{job_config["ltx_path"]}"\n'
         else:
             ltxfiles_block += '    ""\n'
 
-    tcl_script = (
-        "puts \"=== Starting FPGA Programming ===\"\n\n"
-        "open_hw_manager -quiet\n"
-        f"connect_hw_server -url {job_config['hw_server']} -allow_non_jtag -quiet\n\n"
-
-        "# --- List all targets before opening any ---\n"
-        "puts \"Listing all hardware targets before opening:\"\n"
-        "set all_targets [get_hw_targets]\n"
-        "foreach t $all_targets { puts \"  Target: $t\" }\n\n"
-
-        "set hw_targets {\n" + hw_targets_block + "}\n\n"
-        "set bitfiles {\n" + bitfiles_block + "}\n\n"
-        "set ltxfiles {\n" + ltxfiles_block + "}\n\n"
-
-        "set num_targets [llength $hw_targets]\n"
-        "puts \"Found $num_targets target(s) to program\"\n\n"
-
-        "for {set i 0} {$i < $num_targets} {incr i} {\n"
-        "    set target_info [lindex $hw_targets $i]\n"
-        "    set target_path [lindex $target_info 0]\n"
-        "    set device_name [lindex $target_info 1]\n"
-        "    set bitfile [lindex $bitfiles $i]\n"
-        "    set ltxfile [lindex $ltxfiles $i]\n\n"
-
-        "    puts \"----------------------------------------\"\n"
-        "    puts \"Programming target: $target_path\"\n"
-        "    puts \"Device to select: $device_name\"\n\n"
-
-        "    if {[catch {\n"
+    target_body = (
         "        puts \"Opening hardware target...\"\n"
-        "        open_hw_target $target_path -quiet\n\n"
+        + jtag.generate_tcl_chain_command("open_hw_target $target_path") + "\n"
         "        refresh_hw_server -quiet\n\n"
         "        # --- List devices for this target before opening ---\n"
         "        puts \"Listing devices for target $target_path before opening:\"\n"
@@ -114,7 +140,8 @@ def generate_tcl_script(job_config, timestamp):
 
         "        puts \"Selected device: $hw_dev\"\n"
         "        current_hw_device $hw_dev\n"
-        "        refresh_hw_device -update_hw_probes false $hw_dev -quiet\n\n"
+        + jtag.generate_tcl_chain_command("refresh_hw_device -update_hw_probes false $hw_dev") + "\n"
+        + static_check_block +
 
         "        if {$ltxfile != \"\" && [file exists $ltxfile]} {\n"
         "            puts \"Applying LTX file...\"\n"
@@ -124,9 +151,9 @@ def generate_tcl_script(job_config, timestamp):
         "            puts \"No LTX file provided. Skipping probes.\"\n"
         "        }\n\n"
 
-        "        puts \"Programming device...\"\n"
+        f"        puts \"{program_message}\"\n"
         "        set_property PROGRAM.FILE $bitfile $hw_dev\n"
-        "        program_hw_devices $hw_dev\n\n"
+        + jtag.generate_tcl_chain_command("program_hw_devices $hw_dev") + "\n"
 
         "        puts \"Refreshing device...\"\n"
         "        refresh_hw_device $hw_dev -quiet\n\n"
@@ -135,15 +162,46 @@ def generate_tcl_script(job_config, timestamp):
         "        close_hw_target $target_path -quiet\n"
 
         "        puts \"Target programmed successfully.\"\n"
-        "    } err]} {\n"
-        "        puts \"ERROR while programming target: $err\"\n"
-        "        catch { close_hw_target $target_path -quiet }\n"
-        "    }\n"
+    )
+
+    tcl_script = (
+        jtag.TCL_JTAG_PROC +
+        "puts \"=== Starting FPGA Programming ===\"\n\n"
+        "open_hw_manager -quiet\n"
+        f"connect_hw_server -url {job_config['hw_server']} -allow_non_jtag -quiet\n\n"
+
+        "# --- List all targets before opening any ---\n"
+        "puts \"Listing all hardware targets before opening:\"\n"
+        "set all_targets [get_hw_targets]\n"
+        "foreach t $all_targets { puts \"  Target: $t\" }\n\n"
+
+        "set hw_targets {\n" + hw_targets_block + "}\n\n"
+        "set bitfiles {\n" + bitfiles_block + "}\n\n"
+        "set ltxfiles {\n" + ltxfiles_block + "}\n\n"
+
+        "set num_targets [llength $hw_targets]\n"
+        "puts \"Found $num_targets target(s) to program\"\n\n"
+
+        "for {set i 0} {$i < $num_targets} {incr i} {\n"
+        "    set target_info [lindex $hw_targets $i]\n"
+        "    set target_path [lindex $target_info 0]\n"
+        "    set device_name [lindex $target_info 1]\n"
+        "    set bitfile [lindex $bitfiles $i]\n"
+        "    set ltxfile [lindex $ltxfiles $i]\n\n"
+
+        "    puts \"----------------------------------------\"\n"
+        "    puts \"Programming target: $target_path\"\n"
+        "    puts \"Device to select: $device_name\"\n\n"
+
+        + jtag.generate_tcl_target_attempts(target_body, "ERROR while programming target") +
         "}\n\n"
 
         "puts \"=== All targets processed ===\"\n"
     )
 
+    if job_config.get("profile"):
+        tcl_script = profiler.instrument_tcl(tcl_script)
+
     os.makedirs(TCL_FOLDER, exist_ok=True)
     with open(tcl_path, "w") as f:
         f.write(tcl_script)
@@ -161,12 +219,24 @@ def stream_vivado(job_config):
     timestamp = get_timestamp()
     log_filename = f"{SCRIPT_NAME}_{timestamp}.log"
     log_path = os.path.join(LOG_FOLDER, log_filename)
+    timer = metrics.PhaseTimer(SCRIPT_NAME, PHASE_MARKERS)
+    job_start = time.monotonic()
+    status = "error"
+    collector = profiler.ProfileCollector(coordination.current_job_id()) if job_config.get("profile") else None
 
     try:
         tcl_path = generate_tcl_script(job_config, timestamp)
 
         yield {"type": "log", "line": f"Log file: {log_path}\n"}
-        yield {"type": "log", "line": f"TCL file: {tcl_path}\n\n"}
+        yield {"type": "log", "line": f"TCL file: {tcl_path}\n"}
+        if job_config.get("bitstream"):
+            yield {"type": "log", "line": bitstream.describe(job_config["bitstream"])}
+        if job_config.get("partial"):
+            yield {"type": "log", "line":
+                   f"Partial reconfiguration, static design USR_ACCESS 0x{job_config['static_id']:08X}\n"}
+        if job_config.get("clear_bitstream"):
+            yield {"type": "log", "line": "Clearing " + bitstream.describe(job_config["clear_bitstream"])}
+        yield {"type": "log", "line": "\n"}
 
         with open(log_path, "w") as logfile:
 
@@ -182,29 +252,39 @@ def stream_vivado(job_config):
                        f"ERROR: Vivado settings file not found: {VIVADO_SETTINGS}\n"}
                 return
 
-            cmd = (
-                "bash -c '"
-                f"source {VIVADO_SETTINGS} && "
-                f"vivado_lab -mode batch -nojournal -nolog -source {tcl_path}"
-                "'"
-            )
-
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                shell=True,
-                text=True,
-                bufsize=1
-            )
+            process = vivado_env.launch_vivado(VIVADO_SETTINGS, tcl_path)
+            coordination.register_process(process)
+            timer.start("vivado_startup")
+            target_failures = 0
 
             for line in iter(process.stdout.readline, ''):
+                timer.feed(line)
+                if collector:
+                    collector.feed(line)
+                if line.lstrip().startswith("ERROR while programming"):
+                    target_failures += 1
+                if line.startswith("#JTAG_FALLBACK"):
+                    fallback = jtag.parse_fallback(line, job_config["hw_server"])
+                    if fallback:
+                        jtag.save_frequency(fallback["hw_server"], fallback["target"], fallback["frequency"])
+                        yield fallback
                 result = write_and_yield(line)
                 if result:
                     yield result
 
             process.stdout.close()
             process.wait()
+            timer.stop()
+
+            if target_failures:
+                metrics.target_failures_total.inc(target_failures, job=SCRIPT_NAME)
+            status = "ok" if process.returncode == 0 and not target_failures else "failed"
+
+            if collector:
+                profile = collector.result()
+                profile_path = profiler.save_profile(profile)
+                yield {"type": "log", "line": f"Profile file: {profile_path}\n"}
+                yield {"type": "profile", "profile": profile}
 
             yield {"type": "log",
                    "line": "\n===== FPGA Programming Finished =====\n"}
@@ -214,33 +294,39 @@ def stream_vivado(job_config):
         yield {"type": "log", "line": error_text}
         with open(log_path, "a") as logfile:
             logfile.write(error_text)
+    finally:
+        timer.stop()
+        metrics.jobs_total.inc(job=SCRIPT_NAME, status=status)
+        metrics.job_duration_seconds.observe(time.monotonic() - job_start, job=SCRIPT_NAME)
 
 # ==============================
 # Job Queue
 # ==============================
 
+def get_cables(job_config):
+    """
+    Cables a job holds while it runs (see coordination.get_cables).
+    """
+    return coordination.get_cables(job_config["targets"])
+
+
 def enqueue_job(job_config):
-    result_queue = queue.Queue()
-    job_queue.put((job_config, result_queue))
-
-    while True:
-        line = result_queue.get()
-        if line is None:
-            break
-        yield line
-
-
-def job_worker():
-    while True:
-        job_config, result_queue = job_queue.get()
-        try:
-            for line in stream_vivado(job_config):
-                result_queue.put(line)
-        except Exception as e:
-            result_queue.put(f"\n===== Worker Exception =====\n{str(e)}\n")
-        finally:
-            result_queue.put(None)
-            job_queue.task_done()
-
-
-threading.Thread(target=job_worker, daemon=True).start()
+    """
+    Submits a job to the shared queue and yields its output, starting with
+    a "job" item that carries the job id.
+    """
+    job_id = coordination.submit(SCRIPT_NAME, job_config, get_cables(job_config))
+    metrics.active_sessions.inc(job=SCRIPT_NAME)
+
+    try:
+        yield {"type": "job", "job_id": job_id}
+        yield from coordination.stream_output(job_id)
+    finally:
+        metrics.active_sessions.dec(job=SCRIPT_NAME)
+
+
+def start_worker():
+    """
+    Starts this tab's worker; called by app.start_workers in the serving process.
+    """
+    coordination.start_worker(SCRIPT_NAME, stream_vivado)
@@ -1,10 +1,15 @@
 import os
-import subprocess
-import queue
-import threading
 import traceback
+import time
 from datetime import datetime
 
+import bitstream
+import coordination
+import jtag
+import metrics
+import profiler
+import vivado_env
+
 # ==============================
 # Configuration
 # ==============================
@@ -14,15 +19,38 @@ BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
 UPLOAD_FOLDER = os.path.join(BASE_DIR, "uploads")
 LOG_FOLDER = os.path.join(BASE_DIR, "vivado_logs")
 TCL_FOLDER = os.path.join(BASE_DIR, "tcl")
+READBACK_FOLDER = os.path.join(BASE_DIR, "readback")
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(LOG_FOLDER, exist_ok=True)
 os.makedirs(TCL_FOLDER, exist_ok=True)
+os.makedirs(READBACK_FOLDER, exist_ok=True)
 
 VIVADO_SETTINGS = "/tools/Xilinx/Vivado_Lab/2022.2/settings64.sh"
 SCRIPT_NAME = "program-xilinx-fpga-flash"
 
-job_queue = queue.Queue()
+# Verify strategies offered after programming the flash:
+#   none     - no verification
+#   checksum - Vivado compares a checksum of the flash against the file
+#   full     - full readback and compare (slowest)
+#   sampled  - read back a few sectors and compare them against the .bin here
+VERIFY_MODES = ("none", "checksum", "full", "sampled")
+SAMPLE_SECTOR_SIZE = 64 * 1024
+SAMPLE_SECTOR_COUNT = 8
+
+# Job phases timed for /metrics, keyed by the TCL `puts` marker that starts them
+PHASE_MARKERS = {
+    "=== Starting FPGA Flash Memory Programming ===": "hw_server_connect",
+    "Programming flash memory on target:": None,
+    "Opening hardware target...": "open_target",
+    "Creating HW config memory...": "program",
+    "Verifying flash memory": "verify",
+    "#VERIFY ": None,
+    "Target flash programmed successfully.": None,
+    "JTAG failure at": None,
+    "ERROR while programming": None,
+    "=== All flash targets processed ===": None,
+}
 
 
 # ==============================
@@ -30,7 +58,114 @@ job_queue = queue.Queue()
 # ==============================
 
 def get_timestamp():
-    return datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    return datetime.now().strftime("%Y-%m-%d_%H-%M-%S_%f")
+
+
+def get_verify_mode(job_config):
+    """
+    Returns the verify strategy of a job. Jobs without a verify_mode fall
+    back to the old boolean "verify" flag (full readback or nothing).
+    """
+    mode = job_config.get("verify_mode")
+    if not mode:
+        mode = "full" if job_config.get("verify", True) else "none"
+    if mode not in VERIFY_MODES:
+        raise ValueError(f"Unknown verify mode: {mode}")
+    return mode
+
+
+def get_sample_sectors(size, count=SAMPLE_SECTOR_COUNT, sector_size=SAMPLE_SECTOR_SIZE):
+    """
+    Returns (offset, length) pairs of the sectors read back in sampled
+    verify mode: the first and last sector plus evenly spaced ones between.
+    """
+    num_sectors = max(1, (size + sector_size - 1) // sector_size)
+    count = max(1, min(count, num_sectors))
+    if count == 1:
+        indices = [0]
+    else:
+        indices = sorted({round(n * (num_sectors - 1) / (count - 1)) for n in range(count)})
+
+    sectors = []
+    for index in indices:
+        offset = index * sector_size
+        sectors.append((offset, min(sector_size, size - offset)))
+    return sectors
+
+
+def compare_sample(bin_path, offset, length, sample_path):
+    """
+    Compares a sector read back from flash with the same range of the .bin.
+    """
+    with open(bin_path, "rb") as f:
+        f.seek(offset)
+        expected = f.read(length)
+    with open(sample_path, "rb") as f:
+        actual = f.read(length)
+    return expected == actual
+
+
+def generate_tcl_verify(job_config, timestamp):
+    """
+    Returns the TCL block that verifies the flash after programming. Each
+    strategy ends with a "#VERIFY <target> <mode> <PASS|FAIL> <ms>" marker
+    which stream_vivado_flash turns into a per-target verify result. A FAIL
+    raises a TCL error so the target is reported as failed.
+    """
+    mode = get_verify_mode(job_config)
+
+    if mode == "none":
+        return (
+            "        # --- Verify skipped ---\n"
+            "        puts \"#VERIFY $target_path none SKIPPED 0\"\n"
+        )
+
+    block = (
+        f"        # --- Verify flash contents ({mode}) ---\n"
+        f"        puts \"Verifying flash memory ({mode})...\"\n"
+        "        set cfgmem [get_property PROGRAM.HW_CFGMEM $hw_dev_lindex]\n"
+        "        set verify_start [clock milliseconds]\n"
+        "        set verify_status PASS\n"
+    )
+
+    if mode == "sampled":
+        image = job_config.get("bitstream") or bitstream.get_bitstream_metadata(job_config["bin_file"])
+        sectors = get_sample_sectors(image["size"])
+        sectors_list = " ".join(f"0x{offset:08X} {length}" for offset, length in sectors)
+        sample_prefix = os.path.join(READBACK_FOLDER, f"{SCRIPT_NAME}_{timestamp}")
+        block += (
+            f"        foreach {{offset count}} {{{sectors_list}}} {{\n"
+            f"            set sample_file [format \"%s_%d_%s.bin\" \"{sample_prefix}\" $i $offset]\n"
+            "            if {[catch {readback_hw_cfgmem -force -format bin -offset $offset -datacount $count -file $sample_file $cfgmem} verify_err]} {\n"
+            "                puts \"Readback failed at $offset: $verify_err\"\n"
+            "                set verify_status FAIL\n"
+            "                break\n"
+            "            }\n"
+            "            puts \"#VERIFY_SAMPLE $target_path $offset $count $sample_file\"\n"
+            "        }\n"
+        )
+    else:
+        full = int(mode == "full")
+        checksum_only = int(mode == "checksum")
+        block += (
+            "        set_property PROGRAM.BLANK_CHECK 0 $cfgmem\n"
+            "        set_property PROGRAM.ERASE 0 $cfgmem\n"
+            "        set_property PROGRAM.CFG_PROGRAM 0 $cfgmem\n"
+            f"        set_property PROGRAM.VERIFY {full} $cfgmem\n"
+            f"        set_property PROGRAM.CHECKSUM {checksum_only} $cfgmem\n"
+            "        if {[catch {program_hw_cfgmem -hw_cfgmem $cfgmem} verify_err]} {\n"
+            "            puts \"Verify failed: $verify_err\"\n"
+            "            set verify_status FAIL\n"
+            "        }\n"
+        )
+
+    block += (
+        f"        puts \"#VERIFY $target_path {mode} $verify_status [expr {{[clock milliseconds] - $verify_start}}]\"\n"
+        "        if {$verify_status eq \"FAIL\"} {\n"
+        f"            error \"Flash verification ({mode}) failed\"\n"
+        "        }\n"
+    )
+    return block
 
 
 # ==============================
@@ -51,7 +186,7 @@ def generate_tcl_flash(job_config, timestamp):
     blank_check = int(job_config.get("blank_check", False))
     erase = int(job_config.get("erase", False))
     cfg_program = int(job_config.get("cfg_program", True))
-    verify = int(job_config.get("verify", True))
+    verify_block = generate_tcl_verify(job_config, timestamp)
 
     tcl_filename = f"{SCRIPT_NAME}_{timestamp}.tcl"
     tcl_path = os.path.join(TCL_FOLDER, tcl_filename)
@@ -59,28 +194,11 @@ def generate_tcl_flash(job_config, timestamp):
     hw_targets_block = ""
     for t in targets:
         full_target = f"{job_config['hw_server']}/{t['target']}"
-        hw_targets_block += f'    {{{full_target} {t["device"]}}}\n'
-
-    tcl_script = (
-        "puts \"=== Starting FPGA Flash Memory Programming ===\"\n\n"
-        "open_hw_manager -quiet\n"
-        f"connect_hw_server -url {hw_server} -allow_non_jtag -quiet\n\n"
-        f"set hw_targets {{\n{hw_targets_block}}}\n\n"
-        "set num_targets [llength $hw_targets]\n"
-        "puts \"Found $num_targets target(s) to program\"\n\n"
+        hw_targets_block += f'    {{{full_target} {t["device"]} {jtag.get_frequency_attempts(t)}}}\n'
 
-        "for {set i 0} {$i < $num_targets} {incr i} {\n"
-        "    set target_info [lindex $hw_targets $i]\n"
-        "    set target_path [lindex $target_info 0]\n"
-        "    set device_name [lindex $target_info 1]\n\n"
-
-        "    puts \"----------------------------------------\"\n"
-        "    puts \"Programming flash memory on target: $target_path\"\n"
-        "    puts \"Device to select: $device_name\"\n\n"
-
-        "    if {[catch {\n"
+    target_body = (
         "        puts \"Opening hardware target...\"\n"
-        "        open_hw_target $target_path -quiet\n"
+        + jtag.generate_tcl_chain_command("open_hw_target $target_path") +
         "        refresh_hw_server -quiet\n\n"
 
         "        # --- Find device that matches device_name using substring ---\n"
@@ -99,7 +217,7 @@ def generate_tcl_flash(job_config, timestamp):
         "        }\n\n"
         "        puts \"Selected device: $hw_dev\"\n"
         "        current_hw_device $hw_dev\n"
-        "        refresh_hw_device -update_hw_probes false $hw_dev -quiet\n\n"
+        + jtag.generate_tcl_chain_command("refresh_hw_device -update_hw_probes false $hw_dev") + "\n"
 
         "        # --- Check and remove existing attached memories ---\n"
         "        puts \"Checking existing attached memories...\"\n"
@@ -120,7 +238,7 @@ def generate_tcl_flash(job_config, timestamp):
         f"        set_property PROGRAM.BLANK_CHECK {blank_check} [get_property PROGRAM.HW_CFGMEM $hw_dev_lindex]\n"
         f"        set_property PROGRAM.ERASE {erase} [get_property PROGRAM.HW_CFGMEM $hw_dev_lindex]\n"
         f"        set_property PROGRAM.CFG_PROGRAM {cfg_program} [get_property PROGRAM.HW_CFGMEM $hw_dev_lindex]\n"
-        f"        set_property PROGRAM.VERIFY {verify} [get_property PROGRAM.HW_CFGMEM $hw_dev_lindex]\n"
+        "        set_property PROGRAM.VERIFY 0 [get_property PROGRAM.HW_CFGMEM $hw_dev_lindex]\n"
         "        set_property PROGRAM.CHECKSUM 0 [get_property PROGRAM.HW_CFGMEM $hw_dev_lindex]\n"
         # "        refresh_hw_device $hw_dev_lindex\n\n"
 
@@ -131,23 +249,45 @@ def generate_tcl_flash(job_config, timestamp):
 
                 "        # --- Bitstream programming ---\n"
         "        create_hw_bitstream -hw_device $hw_dev_lindex [get_property PROGRAM.HW_CFGMEM_BITFILE $hw_dev_lindex]\n"
-        "        program_hw_devices $hw_dev_lindex\n"
+        + jtag.generate_tcl_chain_command("program_hw_devices $hw_dev_lindex") +
         "        refresh_hw_device $hw_dev_lindex\n\n"
 
         "        # --- Program the flash memory ---\n"
         "        program_hw_cfgmem -hw_cfgmem [get_property PROGRAM.HW_CFGMEM $hw_dev_lindex]\n"
-        "        endgroup\n"
+        "        endgroup\n\n"
+        + verify_block +
+        "\n"
         "        refresh_hw_device -quiet $hw_dev_lindex\n"
         "        close_hw_target $target_path -quiet\n"
         "        puts \"Target flash programmed successfully.\"\n"
-        "    } err]} {\n"
-        "        puts \"ERROR while programming flash memory: $err\"\n"
-        "        catch { close_hw_target $target_path -quiet }\n"
-        "    }\n"
+    )
+
+    tcl_script = (
+        jtag.TCL_JTAG_PROC +
+        "puts \"=== Starting FPGA Flash Memory Programming ===\"\n\n"
+        "open_hw_manager -quiet\n"
+        f"connect_hw_server -url {hw_server} -allow_non_jtag -quiet\n\n"
+        f"set hw_targets {{\n{hw_targets_block}}}\n\n"
+        "set num_targets [llength $hw_targets]\n"
+        "puts \"Found $num_targets target(s) to program\"\n\n"
+
+        "for {set i 0} {$i < $num_targets} {incr i} {\n"
+        "    set target_info [lindex $hw_targets $i]\n"
+        "    set target_path [lindex $target_info 0]\n"
+        "    set device_name [lindex $target_info 1]\n\n"
+
+        "    puts \"----------------------------------------\"\n"
+        "    puts \"Programming flash memory on target: $target_path\"\n"
+        "    puts \"Device to select: $device_name\"\n\n"
+
+        + jtag.generate_tcl_target_attempts(target_body, "ERROR while programming flash memory") +
         "}\n"
         "puts \"=== All flash targets processed ===\"\n"
     )
 
+    if job_config.get("profile"):
+        tcl_script = profiler.instrument_tcl(tcl_script)
+
     os.makedirs(TCL_FOLDER, exist_ok=True)
     with open(tcl_path, "w") as f:
         f.write(tcl_script)
@@ -163,18 +303,67 @@ def stream_vivado_flash(job_config):
     timestamp = get_timestamp()
     log_filename = f"{SCRIPT_NAME}_{timestamp}.log"
     log_path = os.path.join(LOG_FOLDER, log_filename)
+    timer = metrics.PhaseTimer(SCRIPT_NAME, PHASE_MARKERS)
+    job_start = time.monotonic()
+    status = "error"
+    collector = profiler.ProfileCollector(coordination.current_job_id()) if job_config.get("profile") else None
 
     try:
+        if not job_config.get("bitstream"):
+            job_config["bitstream"] = bitstream.get_bitstream_metadata(job_config["bin_file"])
+        verify_mode = get_verify_mode(job_config)
         tcl_path = generate_tcl_flash(job_config, timestamp)
 
+        image = job_config["bitstream"]
         yield {"type": "log", "line": f"Log file: {log_path}\n"}
-        yield {"type": "log", "line": f"TCL file: {tcl_path}\n\n"}
+        yield {"type": "log", "line": f"TCL file: {tcl_path}\n"}
+        yield {"type": "log", "line": f"Image: {image['size']} bytes, SHA-256 {image['sha256']}\n"}
+        yield {"type": "log", "line": bitstream.describe(image)}
+        yield {"type": "log", "line": f"Verify mode: {verify_mode}\n\n"}
+
+        # Per-target results of sampled readback, filled from #VERIFY_SAMPLE
+        sample_results = {}
+        # Targets whose sampled sectors mismatched although TCL reported PASS
+        sample_failures = []
 
         with open(log_path, "w") as logfile:
 
+            def parse_verify(text):
+                parts = text.split()
+                if parts[0] == "#VERIFY_SAMPLE" and len(parts) == 5:
+                    target, offset, count, sample_file = parts[1:]
+                    start = time.monotonic()
+                    ok = compare_sample(job_config["bin_file"], int(offset, 0),
+                                        int(count), sample_file)
+                    elapsed = time.monotonic() - start
+                    os.remove(sample_file)
+                    result = sample_results.setdefault(target, {"ok": True, "seconds": 0.0})
+                    result["ok"] = result["ok"] and ok
+                    result["seconds"] += elapsed
+                    if not ok:
+                        return {"type": "log", "line":
+                                f"Sector mismatch at {offset} on target {target}\n"}
+                    return None
+
+                if parts[0] == "#VERIFY" and len(parts) == 5:
+                    target, mode, status, ms = parts[1:]
+                    seconds = int(ms) / 1000.0
+                    if mode == "sampled":
+                        result = sample_results.pop(target, {"ok": False, "seconds": 0.0})
+                        if not result["ok"] and status == "PASS":
+                            # Sectors are compared here, so TCL could not fail the target itself
+                            status = "FAIL"
+                            sample_failures.append(target)
+                        seconds += result["seconds"]
+                    return {"type": "verify", "target": target, "mode": mode,
+                            "result": status, "seconds": round(seconds, 3)}
+                return None
+
             def write_and_yield(text):
                 logfile.write(text)
                 logfile.flush()
+                if text.lstrip().startswith("#VERIFY"):
+                    return parse_verify(text.strip())
                 if not text.lstrip().startswith("#"):
                     return {"type": "log", "line": text}
                 return None
@@ -186,29 +375,46 @@ def stream_vivado_flash(job_config):
                 }
                 return
 
-            cmd = (
-                "bash -c '"
-                f"source {VIVADO_SETTINGS} && "
-                f"vivado_lab -mode batch -nojournal -nolog -source {tcl_path}"
-                "'"
-            )
-
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                shell=True,
-                text=True,
-                bufsize=1
-            )
+            process = vivado_env.launch_vivado(VIVADO_SETTINGS, tcl_path)
+            coordination.register_process(process)
+            timer.start("vivado_startup")
+            target_failures = 0
 
             for line in iter(process.stdout.readline, ''):
+                timer.feed(line)
+                if collector:
+                    collector.feed(line)
+                if line.lstrip().startswith("ERROR while programming"):
+                    target_failures += 1
+                if line.startswith("#JTAG_FALLBACK"):
+                    fallback = jtag.parse_fallback(line, job_config["hw_server"])
+                    if fallback:
+                        jtag.save_frequency(fallback["hw_server"], fallback["target"], fallback["frequency"])
+                        yield fallback
                 result = write_and_yield(line)
+                if result and result["type"] == "verify":
+                    if result["result"] == "FAIL":
+                        metrics.verify_failures_total.inc(job=SCRIPT_NAME)
+                    yield {"type": "log", "line":
+                           f"Verify ({result['mode']}) on {result['target']}: "
+                           f"{result['result']} in {result['seconds']:.2f} s\n"}
                 if result:
                     yield result
 
             process.stdout.close()
             process.wait()
+            timer.stop()
+
+            target_failures += len(sample_failures)
+            if target_failures:
+                metrics.target_failures_total.inc(target_failures, job=SCRIPT_NAME)
+            status = "ok" if process.returncode == 0 and not target_failures else "failed"
+
+            if collector:
+                profile = collector.result()
+                profile_path = profiler.save_profile(profile)
+                yield {"type": "log", "line": f"Profile file: {profile_path}\n"}
+                yield {"type": "profile", "profile": profile}
 
             yield {
                 "type": "log",
@@ -220,38 +426,40 @@ def stream_vivado_flash(job_config):
         yield {"type": "log", "line": error_text}
         with open(log_path, "a") as logfile:
             logfile.write(error_text)
+    finally:
+        timer.stop()
+        metrics.jobs_total.inc(job=SCRIPT_NAME, status=status)
+        metrics.job_duration_seconds.observe(time.monotonic() - job_start, job=SCRIPT_NAME)
 
 
 # ==============================
 # Job Queue
 # ==============================
 
+def get_cables(job_config):
+    """
+    Cables a job holds while it runs (see coordination.get_cables).
+    """
+    return coordination.get_cables(job_config["targets"])
+
+
 def enqueue_job(job_config):
-    result_queue = queue.Queue()
-    job_queue.put((job_config, result_queue))
-
-    while True:
-        line = result_queue.get()
-        if line is None:
-            break
-        yield line
-
-
-def job_worker():
-    while True:
-        job_config, result_queue = job_queue.get()
-        try:
-            for item in stream_vivado_flash(job_config):
-                result_queue.put(item)
-        except Exception as e:
-            result_queue.put({
-                "type": "log",
-                "line": f"\n===== Worker Exception =====\n{str(e)}\n"
-            })
-        finally:
-            result_queue.put(None)
-            job_queue.task_done()
+    """
+    Submits a job to the shared queue and yields its output, starting with
+    a "job" item that carries the job id.
+    """
+    job_id = coordination.submit(SCRIPT_NAME, job_config, get_cables(job_config))
+    metrics.active_sessions.inc(job=SCRIPT_NAME)
 
+    try:
+        yield {"type": "job", "job_id": job_id}
+        yield from coordination.stream_output(job_id)
+    finally:
+        metrics.active_sessions.dec(job=SCRIPT_NAME)
 
 
-threading.Thread(target=job_worker, daemon=True).start()
+def start_worker():
+    """
+    Starts this tab's worker; called by app.start_workers in the serving process.
+    """
+    coordination.start_worker(SCRIPT_NAME, stream_vivado_flash)
@@ -1,10 +1,13 @@
 import os
-import subprocess
-import queue
-import threading
 import traceback
+import time
 from datetime import datetime
 
+import coordination
+import jtag
+import metrics
+import vivado_env
+
 # ==============================
 # Configuration
 # ==============================
@@ -13,17 +16,31 @@ LOG_FOLDER = os.path.join(BASE_DIR, "vivado_logs")
 TCL_FOLDER = os.path.join(BASE_DIR, "tcl")
 VIVADO_SETTINGS = "/tools/Xilinx/Vivado_Lab/2022.2/settings64.sh"
 SCRIPT_NAME = "list-xilinx-targets"
+CALIBRATION_SCRIPT_NAME = "calibrate-jtag-frequency"
+
+# refresh_hw_device reads that must return the same IDCODE for a TCK rate
+# to count as stable during calibration
+CALIBRATION_REFRESHES = 10
 
 os.makedirs(LOG_FOLDER, exist_ok=True)
 
-# Job queue for threaded processing
-job_queue = queue.Queue()
+# Job phases timed for /metrics, keyed by the TCL `puts` marker that starts them
+PHASE_MARKERS = {
+    "=== Listing All Hardware Targets and Devices ===": "hw_server_connect",
+    "Listing all hardware targets:": "scan_targets",
+    "=== Done Listing ===": None,
+}
+CALIBRATION_PHASE_MARKERS = {
+    "=== Calibrating JTAG Frequencies ===": "hw_server_connect",
+    "Calibrating target:": "calibrate_target",
+    "=== Done Calibrating ===": None,
+}
 
 # ==============================
 # Utilities
 # ==============================
 def get_timestamp():
-    return datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    return datetime.now().strftime("%Y-%m-%d_%H-%M-%S_%f")
 
 
 # ==============================
@@ -38,6 +55,9 @@ def stream_list_hw(hw_server):
     timestamp = get_timestamp()
     log_filename = f"{SCRIPT_NAME}_{timestamp}.log"
     log_path = os.path.join(LOG_FOLDER, log_filename)
+    timer = metrics.PhaseTimer(SCRIPT_NAME, PHASE_MARKERS)
+    job_start = time.monotonic()
+    status = "error"
 
     # Tree structure
     tree = {"server": hw_server, "targets": []}
@@ -116,29 +136,20 @@ puts "=== Done Listing ==="
         with open(tcl_path, "w") as f:
             f.write(tcl_script)
 
-        cmd = (
-            "bash -c '"
-            f"source {VIVADO_SETTINGS} && "
-            f"vivado_lab -mode batch -nojournal -nolog -source {tcl_path}"
-            "'"
-        )
-
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            shell=True,
-            text=True,
-            bufsize=1
-        )
+        process = vivado_env.launch_vivado(VIVADO_SETTINGS, tcl_path)
+        coordination.register_process(process)
+        timer.start("vivado_startup")
 
         for line in iter(process.stdout.readline, ""):
+            timer.feed(line)
             visible_line = write_and_yield(line)
             if visible_line:
                 yield {"type": "log", "line": visible_line}
 
         process.stdout.close()
         process.wait()
+        timer.stop()
+        status = "ok" if process.returncode == 0 else "failed"
         yield {"type": "log", "line": "\n===== Listing Finished =====\n"}
         yield {"type": "tree", "tree": tree}
 
@@ -147,41 +158,194 @@ puts "=== Done Listing ==="
         yield {"type": "log", "line": error_text}
         with open(log_path, "a") as logfile:
             logfile.write(error_text)
+    finally:
+        timer.stop()
+        metrics.jobs_total.inc(job=SCRIPT_NAME, status=status)
+        metrics.job_duration_seconds.observe(time.monotonic() - job_start, job=SCRIPT_NAME)
+
+
+# ==============================
+# JTAG frequency calibration
+# ==============================
+def stream_jtag_calibration(hw_server, targets):
+    """
+    Finds the highest stable JTAG clock (PARAM.FREQUENCY) for each target.
+    Rates are tried fastest first; a rate passes when the device can be
+    opened and CALIBRATION_REFRESHES refreshes return the same IDCODE.
+    Each rate found is stored in the server configuration, and a
+    "jtag_calibration" item is yielded per target with the rate (or None).
+    """
+    timestamp = get_timestamp()
+    log_path = os.path.join(LOG_FOLDER, f"{CALIBRATION_SCRIPT_NAME}_{timestamp}.log")
+    timer = metrics.PhaseTimer(CALIBRATION_SCRIPT_NAME, CALIBRATION_PHASE_MARKERS)
+    job_start = time.monotonic()
+    status = "error"
+
+    yield {"type": "log", "line": f"Log file: {log_path}\n\n"}
+
+    try:
+        if not os.path.exists(VIVADO_SETTINGS):
+            yield {"type": "log", "line": f"ERROR: Vivado settings file not found: {VIVADO_SETTINGS}\n"}
+            return
+
+        hw_targets_block = ""
+        for t in targets:
+            hw_targets_block += f"    {{{hw_server}/{t['target']} {t['device']}}}\n"
+        default_freqs = " ".join(str(f) for f in jtag.STANDARD_FREQUENCIES)
+
+        tcl_script = f"""
+puts "=== Calibrating JTAG Frequencies ==="
+open_hw_manager -quiet
+connect_hw_server -url {hw_server} -allow_non_jtag -quiet
+
+set hw_targets {{
+{hw_targets_block}}}
+
+foreach target_info $hw_targets {{
+    set target_path [lindex $target_info 0]
+    set device_name [lindex $target_info 1]
+    puts "----------------------------------------"
+    puts "Calibrating target: $target_path"
+    catch {{ close_hw_target $target_path -quiet }}
+
+    # Use the rates the cable reports, fastest first
+    if {{[catch {{lsort -integer -decreasing [list_property_value PARAM.FREQUENCY [get_hw_targets $target_path]]}} freqs] || $freqs eq {{}}}} {{
+        set freqs {{{default_freqs}}}
+    }}
+
+    foreach freq $freqs {{
+        if {{[catch {{
+            set_property PARAM.FREQUENCY $freq [get_hw_targets $target_path]
+            open_hw_target $target_path -quiet
+            set hw_dev {{}}
+            foreach d [get_hw_devices] {{
+                if {{[string match "*${{device_name}}*" $d]}} {{
+                    set hw_dev $d
+                    break
+                }}
+            }}
+            if {{$hw_dev eq {{}}}} {{
+                error "Device matching $device_name not found!"
+            }}
+            set idcode [get_property IDCODE $hw_dev]
+            for {{set n 0}} {{$n < {CALIBRATION_REFRESHES}}} {{incr n}} {{
+                refresh_hw_device -update_hw_probes false $hw_dev -quiet
+                if {{[get_property IDCODE $hw_dev] ne $idcode}} {{
+                    error "IDCODE changed between reads"
+                }}
+            }}
+            close_hw_target $target_path -quiet
+        }} err]}} {{
+            catch {{ close_hw_target $target_path -quiet }}
+            puts "  $freq Hz: FAIL ($err)"
+            puts "#CAL $target_path $freq FAIL"
+        }} else {{
+            puts "  $freq Hz: PASS"
+            puts "#CAL $target_path $freq PASS"
+            break
+        }}
+    }}
+}}
+
+puts "=== Done Calibrating ==="
+"""
+        tcl_path = os.path.join(TCL_FOLDER, f"{CALIBRATION_SCRIPT_NAME}_{timestamp}.tcl")
+        with open(tcl_path, "w") as f:
+            f.write(tcl_script)
+
+        best = {f"{hw_server}/{t['target']}": None for t in targets}
+
+        process = vivado_env.launch_vivado(VIVADO_SETTINGS, tcl_path)
+        coordination.register_process(process)
+        timer.start("vivado_startup")
+
+        with open(log_path, "a") as logfile:
+            for line in iter(process.stdout.readline, ""):
+                timer.feed(line)
+                logfile.write(line)
+                logfile.flush()
+
+                parts = line.split()
+                if len(parts) == 4 and parts[0] == "#CAL" and parts[3] == "PASS":
+                    best[parts[1]] = int(parts[2])
+                if not line.lstrip().startswith("#"):
+                    yield {"type": "log", "line": line}
+
+        process.stdout.close()
+        process.wait()
+        timer.stop()
+        status = "ok" if process.returncode == 0 else "failed"
+
+        yield {"type": "log", "line": "\n===== Calibration Finished =====\n"}
+        for t in targets:
+            frequency = best[f"{hw_server}/{t['target']}"]
+            if frequency:
+                jtag.save_frequency(hw_server, t["target"], frequency)
+            result = f"{frequency} Hz" if frequency else "no stable rate found"
+            yield {"type": "log", "line": f"{t['target']}: {result}\n"}
+            yield {"type": "jtag_calibration", "hw_server": hw_server,
+                   "target": t["target"], "frequency": frequency}
+
+    except Exception:
+        error_text = "\n===== Python Exception =====\n" + traceback.format_exc()
+        yield {"type": "log", "line": error_text}
+        with open(log_path, "a") as logfile:
+            logfile.write(error_text)
+    finally:
+        timer.stop()
+        metrics.jobs_total.inc(job=CALIBRATION_SCRIPT_NAME, status=status)
+        metrics.job_duration_seconds.observe(time.monotonic() - job_start, job=CALIBRATION_SCRIPT_NAME)
 
 
 # ==============================
 # Job Queue
 # ==============================
-def enqueue_hw_list(hw_server):
+def enqueue_hw_list(hw_server, targets):
     """
     Adds a hardware listing job to the queue.
     Returns a generator yielding log lines and final tree.
     """
-    result_queue = queue.Queue()
-    job_queue.put((hw_server, result_queue))
+    # Listing opens every target of the server, so it holds all configured ones
+    return enqueue_job({"action": "list", "hw_server": hw_server}, coordination.get_cables(targets))
 
-    while True:
-        line = result_queue.get()
-        if line is None:
-            break
-        yield line
+
+def enqueue_jtag_calibration(hw_server, targets):
+    """
+    Adds a JTAG frequency calibration job to the queue.
+    Returns a generator yielding log lines and per-target results.
+    The job holds the cables of its targets, so it never runs while an FPGA
+    or flash job (or an older queued job) uses one of them.
+    """
+    cables = coordination.get_cables(targets)
+    return enqueue_job({"action": "calibrate", "hw_server": hw_server, "targets": targets}, cables)
+
+
+def enqueue_job(payload, cables):
+    """
+    Submits a job to the shared queue and yields its output, starting with
+    a "job" item that carries the job id.
+    """
+    job_id = coordination.submit(SCRIPT_NAME, payload, cables)
+    metrics.active_sessions.inc(job=SCRIPT_NAME)
+
+    try:
+        yield {"type": "job", "job_id": job_id}
+        yield from coordination.stream_output(job_id)
+    finally:
+        metrics.active_sessions.dec(job=SCRIPT_NAME)
+
+
+def run_job(payload):
+    """
+    Worker handler: runs a queued listing or calibration job.
+    """
+    if payload["action"] == "calibrate":
+        return stream_jtag_calibration(payload["hw_server"], payload["targets"])
+    return stream_list_hw(payload["hw_server"])
 
 
-def job_worker():
+def start_worker():
     """
-    Thread worker to process jobs from the queue.
+    Starts this tab's worker; called by app.start_workers in the serving process.
     """
-    while True:
-        hw_server, result_queue = job_queue.get()
-        try:
-            for item in stream_list_hw(hw_server):
-                result_queue.put(item)
-        except Exception as e:
-            result_queue.put({"type": "log", "line": f"\n===== Worker Exception =====\n{str(e)}\n"})
-        finally:
-            result_queue.put(None)
-            job_queue.task_done()
-
-
-# Start worker thread
-threading.Thread(target=job_worker, daemon=True).start()
+    coordination.start_worker(SCRIPT_NAME, run_job)
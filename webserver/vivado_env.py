@@ -0,0 +1,80 @@
+import os
+import shutil
+import subprocess
+import threading
+
+# ==============================
+# Vivado environment cache
+# ==============================
+# Sourcing Xilinx's settings64.sh takes seconds. It is evaluated once per
+# settings file (and again whenever the file changes) and vivado_lab is then
+# started directly with the captured environment, without a shell.
+
+_env_cache = {}
+_env_lock = threading.Lock()
+
+
+def load_vivado_env(settings_path):
+    """
+    Sources the settings script in a clean bash and returns the resulting
+    environment as a dict.
+    """
+    result = subprocess.run(
+        ["bash", "-c", 'source "$1" >/dev/null 2>&1 && env -0', "vivado-settings", settings_path],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+    env = {}
+    for entry in result.stdout.decode(errors="replace").split("\0"):
+        if "=" in entry:
+            key, value = entry.split("=", 1)
+            env[key] = value
+    return env
+
+
+def get_vivado_env(settings_path):
+    """
+    Returns the cached environment for settings_path, reloading it if the
+    settings file was modified since it was captured.
+    """
+    mtime = os.path.getmtime(settings_path)
+    with _env_lock:
+        cached = _env_cache.get(settings_path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        env = load_vivado_env(settings_path)
+        _env_cache[settings_path] = (mtime, env)
+        return env
+
+
+def preload(settings_path):
+    """
+    Warms the cache at server startup. Missing or broken settings are
+    reported by the jobs themselves, so errors are ignored here.
+    """
+    try:
+        get_vivado_env(settings_path)
+    except (OSError, subprocess.CalledProcessError):
+        pass
+
+
+def launch_vivado(settings_path, tcl_path):
+    """
+    Starts vivado_lab in batch mode on tcl_path with the cached environment.
+    Output (stdout and stderr) is returned line-buffered as text.
+    """
+    env = get_vivado_env(settings_path)
+    vivado = shutil.which("vivado_lab", path=env.get("PATH"))
+    if vivado is None:
+        raise FileNotFoundError(f"vivado_lab not found on PATH after sourcing {settings_path}")
+
+    return subprocess.Popen(
+        [vivado, "-mode", "batch", "-nojournal", "-nolog", "-source", tcl_path],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        env=env,
+        text=True,
+        bufsize=1
+    )